@@ -36,7 +36,7 @@
 # % key: directory
 # % required: no
 # % multiple: no
-# % label: Directory path where to download and temporarily store the data. If not set the data will be downloaded to a temporary directory. The downloaded data will be removed after the import
+# % label: Directory path where to download and store the data. Tiles already present in this directory are not downloaded again. If not set the data will be downloaded to a temporary directory which is removed after the import
 # %end
 
 # %option G_OPT_MEMORYMB
@@ -48,38 +48,97 @@
 # %end
 
 import atexit
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
+import math
 import os
+import posixpath
 import psutil
+import requests
+from requests.adapters import HTTPAdapter
 import shutil
+import subprocess
 import sys
-import wget
+from urllib3.util.retry import Retry
 
 import grass.script as grass
+from osgeo import gdal
+
+# report GDAL errors as exceptions (and avoid the FutureWarning of GDAL >= 3.7)
+gdal.UseExceptions()
 
 rm_files = []
 rm_folders = []
-rm_rasters = []
+
+# maximum number of parallel tile downloads
+MAX_DOWNLOAD_WORKERS = 8
+# number of attempts to download a valid tile
+DOWNLOAD_ATTEMPTS = 3
+# minimum size in bytes of a previously downloaded tile to be reused
+MIN_TILE_SIZE = 1024
+# tolerance in degrees for the intersection of the region with a tile
+TILE_EPSILON = 1e-6
+
+# class codes and labels of the discrete classification
+DISCRETE_CLASSIFICATION_CODING = (
+    (10, "Cropland"),
+    (20, "Forest"),
+    (30, "Grassland"),
+    (40, "Shrubland"),
+    (50, "Wetland"),
+    (60, "Water"),
+    (70, "Tundra"),
+    (80, "Impervious surface"),
+    (90, "Bareland"),
+    (100, "Snow/Ice"),
+)
+# r.category rules for the classification, encoded once at import
+CATEGORY_RULES = "".join(
+    "%s|%s\n" % (class_num, class_text)
+    for class_num, class_text in DISCRETE_CLASSIFICATION_CODING
+).encode()
+
+# GDAL configuration to read the tiles remotely via /vsicurl/, fetching only
+# the byte ranges that are needed for the current region
+VSICURL_CONFIG = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "CPL_VSIL_CURL_USE_HEAD": "NO",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    # retry transient HTTP errors like the download session does
+    "GDAL_HTTP_MAX_RETRY": "5",
+    "GDAL_HTTP_RETRY_DELAY": "1",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(256 * 1024 ** 2),
+}
+
+# one HTTP session shared by all download threads, so that connections
+# are kept alive and reused for subsequent tiles
+SESSION = requests.Session()
+SESSION.mount(
+    "http://",
+    HTTPAdapter(
+        pool_connections=MAX_DOWNLOAD_WORKERS,
+        pool_maxsize=MAX_DOWNLOAD_WORKERS,
+        max_retries=Retry(total=5, backoff_factor=0.5),
+    ),
+)
 
 
 def cleanup():
     grass.message(_("Cleaning up..."))
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
     for rmfile in rm_files:
         try:
             os.remove(rmfile)
         except Exception as e:
             grass.warning(_("Cannot remove file <%s>: %s" % (rmfile, e)))
+
+    def warn_rmtree_error(function, path, excinfo):
+        grass.warning(_("Cannot remove <%s>: %s" % (path, excinfo[1])))
+
     for folder in rm_folders:
         if os.path.isdir(folder):
-            try:
-                shutil.rmtree(folder)
-            except Exception as e:
-                grass.warning(_("Cannot remove dir <%s>: %s" % (folder, e)))
+            shutil.rmtree(folder, onerror=warn_rmtree_error)
 
 
 def freeRAM(unit, percent=100):
@@ -89,24 +148,18 @@ def freeRAM(unit, percent=100):
         percent(int): number of percent which shoud be used of the free RAM
                       default 100%
     Returns:
-        memory_MB_percent/memory_GB_percent(int): percent of the free RAM in
-                                                  MB or GB
+        (int): percent of the free RAM in MB or GB
 
     """
     # use psutil cause of alpine busybox free version for RAM/SWAP usage
-    mem_available = psutil.virtual_memory().available
-    swap_free = psutil.swap_memory().free
-    memory_GB = (mem_available + swap_free) / 1024.0 ** 3
-    memory_MB = (mem_available + swap_free) / 1024.0 ** 2
-
+    memory_available = psutil.virtual_memory().available + psutil.swap_memory().free
     if unit == "MB":
-        memory_MB_percent = memory_MB * percent / 100.0
-        return int(round(memory_MB_percent))
+        denominator = 1024 ** 2
     elif unit == "GB":
-        memory_GB_percent = memory_GB * percent / 100.0
-        return int(round(memory_GB_percent))
+        denominator = 1024 ** 3
     else:
         grass.fatal(_("Memory unit <%s> not supported" % unit))
+    return int(round(memory_available * percent / (100.0 * denominator)))
 
 
 def test_memory():
@@ -122,38 +175,130 @@ def test_memory():
 
 
 def categories_for_discrete_classification(map):
-    discrete_classification_coding = {
-        "10": "Cropland",
-        "20": "Forest",
-        "30": "Grassland",
-        "40": "Shrubland",
-        "50": "Wetland",
-        "60": "Water",
-        "70": "Tundra",
-        "80": "Impervious surface",
-        "90": "Bareland",
-        "100": "Snow/Ice",
-    }
-    # category
-    category_text = ""
-    for class_num, class_text in discrete_classification_coding.items():
-        category_text += "%s|%s\n" % (class_num, class_text)
-    cat_proc = grass.feed_command("r.category", map=map, rules="-", separator="pipe")
-    cat_proc.stdin.write(category_text.encode())
-    cat_proc.stdin.close()
-    cat_proc.wait()
-
-
-def get_required_tiles():
+    grass.write_command(
+        "r.category", map=map, rules="-", separator="pipe", stdin=CATEGORY_RULES
+    )
+
+
+def download(url, local_path):
+    """Streams the file at url to local_path using the shared session"""
+    with SESSION.get(url, stream=True, timeout=(10, 120)) as response:
+        response.raise_for_status()
+        # the size can only be compared if the content is not encoded
+        expected_size = None
+        if "Content-Encoding" not in response.headers:
+            expected_size = response.headers.get("Content-Length")
+        with open(local_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                file.write(chunk)
+    if expected_size is not None and os.path.getsize(local_path) != int(
+        expected_size
+    ):
+        raise IOError(
+            _("Incomplete download: received {} of {} bytes").format(
+                os.path.getsize(local_path), expected_size
+            )
+        )
+
+
+def is_valid_tile(path):
+    """Checks if path can be opened by GDAL as a non-empty raster"""
+    try:
+        dataset = gdal.Open(path)
+    except RuntimeError:
+        return False
+    return dataset.RasterXSize > 0 and dataset.RasterYSize > 0
+
+
+def supports_range_requests(url):
+    """Checks if the server of url supports HTTP range requests, which are
+    needed to read the tiles remotely via /vsicurl/"""
+    try:
+        response = SESSION.head(url, timeout=(10, 30), allow_redirects=True)
+    except requests.RequestException:
+        return False
+    return response.ok and response.headers.get("Accept-Ranges") == "bytes"
+
+
+def get_region_extent(tif_path):
+    """Returns the extent (west, south, east, north) of the current region,
+    enlarged to the pixel grid of the given tile. The location has to use
+    the CRS of the tile"""
+    region = grass.region()
+    try:
+        dataset = gdal.Open(tif_path)
+    except RuntimeError as e:
+        grass.fatal(_("Cannot open {}: {}").format(tif_path, e))
+    origin_x, res_x, _x_rot, origin_y, _y_rot, res_y = dataset.GetGeoTransform()
+    res_y = abs(res_y)
+    # the small offsets prevent floating point errors from adding a pixel
+    west = origin_x + math.floor((region["w"] - origin_x) / res_x + 1e-6) * res_x
+    east = origin_x + math.ceil((region["e"] - origin_x) / res_x - 1e-6) * res_x
+    north = origin_y - math.floor((origin_y - region["n"]) / res_y + 1e-6) * res_y
+    south = origin_y - math.ceil((origin_y - region["s"]) / res_y - 1e-6) * res_y
+    return west, south, east, north
+
+
+def build_vrt(vrt_path, tif_paths, extent=None):
+    """Builds a GDAL VRT mosaic of the given GeoTIFFs without copying data.
+    If extent (west, south, east, north) is given, the VRT is clipped to it"""
+    cmd = ["gdalbuildvrt", "-q"]
+    if extent:
+        cmd += ["-te"] + [str(coord) for coord in extent]
+    try:
+        subprocess.run(
+            cmd + [vrt_path] + tif_paths,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        grass.fatal(_("gdalbuildvrt is required but could not be found"))
+    except subprocess.CalledProcessError as e:
+        grass.fatal(
+            _("Building the VRT mosaic failed: {}").format(e.stderr.decode().strip())
+        )
+
+
+def location_has_tile_crs():
+    """Checks if the current location uses the CRS of the tiles (EPSG:4326),
+    so that the tiles can be linked without reprojection"""
+    proj = grass.parse_command("g.proj", flags="g")
+    return proj.get("srid") == "EPSG:4326" or proj.get("epsg") == "4326"
+
+
+def get_tile_range(min_coord, max_coord):
+    """Returns the lower tile coordinates of all 2 degree tiles which
+    intersect the interval between min_coord and max_coord. Tiles which are
+    only touched within TILE_EPSILON (e.g. due to rounding in the region
+    reprojection) are skipped"""
+    min_tile = math.floor(min_coord / 2) * 2
+    max_tile = math.floor(max_coord / 2) * 2
+    candidates = range(min_tile, max_tile + 1, 2)
+    tiles = [
+        tile
+        for tile in candidates
+        if tile < max_coord - TILE_EPSILON and tile + 2 > min_coord + TILE_EPSILON
+    ]
+    # a region smaller than TILE_EPSILON still needs the tile it lies in
+    return tiles or [min_tile]
+
+
+def get_required_tiles(region_dict):
     # tiles are of 2 * 2 degrees size
     # the tilename is defined by the lower left corner
-    region_dict = grass.parse_command("g.region", flags="lg")
-    n_tile = int(float(region_dict["nw_lat"]) - float(region_dict["nw_lat"]) % 2)
-    s_tile = int(float(region_dict["sw_lat"]) - float(region_dict["sw_lat"]) % 2)
-    e_tile = int(float(region_dict["nw_long"]) - float(region_dict["nw_long"]) % 2)
-    w_tile = int(float(region_dict["ne_long"]) - float(region_dict["ne_long"]) % 2)
-    required_ns_tiles = list(range(s_tile, n_tile + 1, 2))
-    required_ew_tiles = list(range(e_tile, w_tile + 1, 2))
+    # the region corners are not aligned with latitude/longitude in a
+    # projected location, so use the outer bounds of all corners
+    north = max(float(region_dict["nw_lat"]), float(region_dict["ne_lat"]))
+    south = min(float(region_dict["sw_lat"]), float(region_dict["se_lat"]))
+    west = min(float(region_dict["nw_long"]), float(region_dict["sw_long"]))
+    east = max(float(region_dict["ne_long"]), float(region_dict["se_long"]))
+    required_ns_tiles = get_tile_range(south, north)
+    if east < west:
+        # the region crosses the antimeridian
+        required_ew_tiles = get_tile_range(west, 180) + get_tile_range(-180, east)
+    else:
+        required_ew_tiles = get_tile_range(west, east)
     required_tiles_raw = list(product(required_ns_tiles, required_ew_tiles))
     required_tiles = []
     for tile in required_tiles_raw:
@@ -164,38 +309,138 @@ def get_required_tiles():
 
 def main():
 
-    global rm_rasters, rm_folders, rm_files
+    global rm_folders, rm_files
 
     pid = str(os.getpid())
     baseurl = "http://data.ess.tsinghua.edu.cn/data/fromglc10_2017v01"
-    if options["directory"]:
-        download_dir = options["directory"]
+    user_dir = bool(options["directory"])
+    if user_dir:
+        # linked rasters store the paths of the tiles, which have to stay
+        # valid independent of the working directory
+        download_dir = os.path.abspath(options["directory"])
         if not os.path.isdir(download_dir):
             os.makedirs(download_dir)
     else:
         download_dir = grass.tempdir()
         rm_folders.append(download_dir)
 
-    tiles = get_required_tiles()
-    local_paths = []
-    for tile in tiles:
+    # region corners in latitude/longitude
+    region_dict = grass.parse_command("g.region", flags="lg")
+    tiles = get_required_tiles(region_dict)
+
+    def download_tile(tile):
         local_path = os.path.join(download_dir, tile)
-        url = os.path.join(baseurl, tile)
-        try:
+        url = posixpath.join(baseurl, tile)
+        # download to a temporary name, so that an interrupted download never
+        # appears as a cached tile, and validate it, so that a broken tile is
+        # fetched again instead of failing later in the import
+        part_path = local_path + ".part"
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
             grass.message(_("Downloading {}...").format(url))
-            wget.download(url, local_path)
-            local_paths.append(local_path)
+            try:
+                download(url, part_path)
+                if is_valid_tile(part_path):
+                    os.replace(part_path, local_path)
+                    break
+                error = _("Downloaded file is not a valid GeoTIFF")
+            except Exception as e:
+                error = e
+            grass.warning(
+                _("Attempt {} of {} to download {} failed: {}").format(
+                    attempt, DOWNLOAD_ATTEMPTS, url, error
+                )
+            )
+        else:
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+            grass.fatal(_("There was a problem downloading {}: {}").format(url, error))
+        # tiles in a user given directory are kept as cache for later runs;
+        # list.append is atomic, so no lock is needed here
+        if not user_dir:
             rm_files.append(local_path)
-        except Exception as e:
-            grass.fatal(_("There was a problem downloading {}: {}").format(url, e))
-    grass.message(_("Importing..."))
-    grassnames = []
-    test_memory()
-    for idx, file in enumerate(local_paths):
-        outname = "gong_classification_part_{}_{}".format(idx, pid)
+        return local_path
+
+    if not user_dir and supports_range_requests(posixpath.join(baseurl, tiles[0])):
+        # the tiles would only be downloaded temporarily, so read the needed
+        # parts of them directly from the server instead
+        grass.message(_("Reading the tiles remotely..."))
+        for key, value in VSICURL_CONFIG.items():
+            os.environ.setdefault(key, value)
+        tile_paths = [
+            "/vsicurl/{}".format(posixpath.join(baseurl, tile)) for tile in tiles
+        ]
+    else:
+        # list the directory once and only look closer at required tiles,
+        # other files in a shared directory (including *.part files of
+        # interrupted downloads, which are overwritten) are skipped by name
+        wanted_tiles = set(tiles)
+        with os.scandir(download_dir) as entries:
+            present_tiles = {
+                entry.name
+                for entry in entries
+                if entry.name in wanted_tiles
+                and entry.is_file()
+                and entry.stat().st_size >= MIN_TILE_SIZE
+                and is_valid_tile(entry.path)
+            }
+        needed_tiles = [tile for tile in tiles if tile not in present_tiles]
+        if len(needed_tiles) < len(tiles):
+            grass.message(
+                _("Using {} already downloaded tile(s) from {}").format(
+                    len(tiles) - len(needed_tiles), download_dir
+                )
+            )
+        if needed_tiles:
+            num_workers = min(MAX_DOWNLOAD_WORKERS, len(needed_tiles))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [
+                    executor.submit(download_tile, tile) for tile in needed_tiles
+                ]
+            # all downloads are finished here; result() re-raises the exit of
+            # grass.fatal from a failed download in the main thread
+            for future in futures:
+                future.result()
+        tile_paths = [os.path.join(download_dir, tile) for tile in tiles]
+    # the tiles can only be linked instead of imported if they are kept,
+    # are in the CRS of the location and no resampling is requested
+    link_external = not flags["r"] and user_dir and location_has_tile_crs()
+    if link_external:
+        # r.external links the whole input, so the tiles are always linked
+        # via a VRT which is clipped to the region like r.import does; the
+        # VRT has to be kept together with the tiles and is named after the
+        # location, mapset and map, as the directory may be shared
+        gisenv = grass.gisenv()
+        input_path = os.path.join(
+            download_dir,
+            "{}_{}_{}.vrt".format(
+                gisenv["LOCATION_NAME"], gisenv["MAPSET"], options["output"]
+            ),
+        )
+        build_vrt(input_path, tile_paths, get_region_extent(tile_paths[0]))
+    elif len(tile_paths) == 1:
+        # the region lies within a single tile, which can be used directly
+        input_path = tile_paths[0]
+    else:
+        # mosaic the tiles in a VRT and import it at once instead of
+        # importing and patching each tile
+        input_path = os.path.join(download_dir, "gong_mosaic_{}.vrt".format(pid))
+        rm_files.append(input_path)
+        build_vrt(input_path, tile_paths)
+    if link_external:
+        grass.message(_("Linking..."))
+        grass.run_command(
+            "r.external", input=input_path, output=options["output"], quiet=True
+        )
+    else:
+        grass.message(_("Importing..."))
+        test_memory()
+        # let GDAL in r.import use the given memory as block cache and all
+        # cores for decoding the tiles, unless configured otherwise
+        os.environ.setdefault("GDAL_CACHEMAX", str(int(options["memory"])))
+        os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
         import_kwargs = {
-            "input": file,
-            "output": outname,
+            "input": input_path,
+            "output": options["output"],
             "extent": "region",
             "memory": options["memory"],
         }
@@ -203,19 +448,6 @@ def main():
             import_kwargs["resolution"] = "region"
             import_kwargs["resample"] = "nearest"
         grass.run_command("r.import", **import_kwargs, quiet=True)
-        grassnames.append(outname)
-        rm_rasters.append(outname)
-
-    if len(grassnames) == 1:
-        grass.run_command(
-            "g.rename",
-            raster="{},{}".format(grassnames[0], options["output"]),
-            quiet=True,
-        )
-    else:
-        grass.run_command(
-            "r.patch", input=grassnames, output=options["output"], quiet=True
-        )
 
     categories_for_discrete_classification(options["output"])
     grass.message(_("Generated raster map <{}>").format(options["output"]))
@@ -19,7 +19,9 @@
 #
 ############################################################################
 
+import importlib.util
 import os
+import shutil
 
 from grass.gunittest.case import TestCase
 from grass.gunittest.main import test
@@ -103,6 +105,64 @@ class TestRImportGonglc(TestCase):
             ).format(self.gong_map),
         )
 
+    def run_with_directory(self, download_dir):
+        """Runs r.import.gong_lc at region resolution (-r) with a download
+        directory and returns the names of the tiles in the directory"""
+        gong = SimpleModule(
+            "r.import.gong_lc",
+            output=self.gong_map,
+            directory=download_dir,
+            flags="r",
+            overwrite=True,
+        )
+        self.assertModule(gong)
+        self.assertRasterExists(self.gong_map)
+        return {
+            name
+            for name in os.listdir(download_dir)
+            if name.startswith("fromglc10v01_") and name.endswith(".tif")
+        }
+
+    def test_required_tiles_large_region(self):
+        """Test if exactly the tiles covering a large region are downloaded
+        (same extent as the multi tile test, imported at 500 m resolution)"""
+        grass.run_command("g.region", raster=self.ref_map_large, grow=-200)
+        download_dir = grass.tempdir()
+        self.addCleanup(shutil.rmtree, download_dir, ignore_errors=True)
+        self.assertEqual(
+            self.run_with_directory(download_dir),
+            {
+                "fromglc10v01_34_-84.tif",
+                "fromglc10v01_34_-82.tif",
+                "fromglc10v01_34_-80.tif",
+                "fromglc10v01_34_-78.tif",
+            },
+            "The downloaded tiles do not match the reference",
+        )
+
+    def test_directory_keeps_downloaded_tiles(self):
+        """Test if exactly the tile covering a small region is downloaded to
+        a given directory, kept and reused in a second run"""
+        grass.run_command("g.region", raster=self.ref_map_small)
+        download_dir = grass.tempdir()
+        self.addCleanup(shutil.rmtree, download_dir, ignore_errors=True)
+        tiles = self.run_with_directory(download_dir)
+        self.assertEqual(
+            tiles,
+            {"fromglc10v01_34_-80.tif"},
+            "The downloaded tiles do not match the reference",
+        )
+        mtimes = {
+            tile: os.path.getmtime(os.path.join(download_dir, tile)) for tile in tiles
+        }
+        self.run_with_directory(download_dir)
+        for tile, mtime in mtimes.items():
+            self.assertEqual(
+                os.path.getmtime(os.path.join(download_dir, tile)),
+                mtime,
+                "Tile {} was downloaded again".format(tile),
+            )
+
     def test_multi_tile_gong_import(self):
         """Test if gong_lc is imported successfully for a large area
         (= multiple tiles)"""
@@ -159,5 +219,75 @@ class TestRImportGonglc(TestCase):
         )
 
 
+class TestRequiredTiles(TestCase):
+    """Tests the tile selection for constructed regions without downloading"""
+
+    @classmethod
+    def setUpClass(self):
+        """Loads the module script, which has no importable module name"""
+        script = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "r.import.gong_lc.py"
+        )
+        spec = importlib.util.spec_from_file_location("r_import_gong_lc", script)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+    @staticmethod
+    def region_dict(north, south, west, east):
+        """Returns the corners of a region like g.region -lg"""
+        return {
+            "nw_lat": str(north),
+            "ne_lat": str(north),
+            "sw_lat": str(south),
+            "se_lat": str(south),
+            "nw_long": str(west),
+            "sw_long": str(west),
+            "ne_long": str(east),
+            "se_long": str(east),
+        }
+
+    def test_tile_range_on_tile_border(self):
+        """Test that a region ending on a tile border does not add the next
+        tile"""
+        self.assertEqual(self.module.get_tile_range(34.0, 36.0), [34])
+        self.assertEqual(self.module.get_tile_range(33.9999999, 36.0000001), [34])
+        self.assertEqual(self.module.get_tile_range(35.1, 36.5), [34, 36])
+
+    def test_tile_range_negative(self):
+        """Test the tile range for negative coordinates"""
+        self.assertEqual(self.module.get_tile_range(-3.5, 1), [-4, -2, 0])
+        self.assertEqual(self.module.get_tile_range(-78.8, -78.6), [-80])
+
+    def test_required_tiles_negative_longitudes(self):
+        """Test the tiles of a region west of Greenwich and on tile borders"""
+        tiles = self.module.get_required_tiles(
+            self.region_dict(north=36, south=34, west=-83.3, east=-76.2)
+        )
+        self.assertEqual(
+            tiles,
+            [
+                "fromglc10v01_34_-84.tif",
+                "fromglc10v01_34_-82.tif",
+                "fromglc10v01_34_-80.tif",
+                "fromglc10v01_34_-78.tif",
+            ],
+        )
+
+    def test_required_tiles_antimeridian(self):
+        """Test the tiles of a region crossing the antimeridian"""
+        tiles = self.module.get_required_tiles(
+            self.region_dict(north=1, south=-0.5, west=179, east=-179)
+        )
+        self.assertEqual(
+            tiles,
+            [
+                "fromglc10v01_-2_178.tif",
+                "fromglc10v01_-2_-180.tif",
+                "fromglc10v01_0_178.tif",
+                "fromglc10v01_0_-180.tif",
+            ],
+        )
+
+
 if __name__ == "__main__":
     test()